@@ -3,140 +3,199 @@ import torch
 import lxt.explicit.functional as lf
 from torch.nn import functional as F
 import torch.nn as nn
+from torch.testing import assert_close
 
 
-def test_softmax():
+@pytest.fixture(scope="module", autouse=True)
+def single_thread():
+    """
+    All tensors in this module are tiny, so intra-op parallelism costs more than it saves.
+    The thread count is restored afterwards to not slow down other test modules.
+    """
+    num_threads = torch.get_num_threads()
+    torch.set_num_threads(1)
+    yield
+    torch.set_num_threads(num_threads)
 
-    x = torch.randn(16, 10, 32, requires_grad=True)
-    init_relevance = torch.randn(16, 10, 32, requires_grad=True)
 
-    y_gt = F.softmax(x, -1)
+@pytest.fixture(scope="module")
+def rng():
+    g = torch.Generator()
+    g.manual_seed(0)
+    return g
 
-    # implement Proposition 3.1 of AttnLRP paper
-    relevance_gt = x.float() * (init_relevance - y_gt * init_relevance.sum(-1, keepdim=True))
 
-    # test inplace=False
-    y_lxt = lf.softmax(x, -1, torch.float32, False)
-    relevance_lxt, = torch.autograd.grad(y_lxt, x, init_relevance)
-    assert torch.allclose(relevance_gt, relevance_lxt, rtol=0, atol=1e-5)
+@pytest.fixture(scope="module")
+def tensors(rng):
+    """
+    Pre-generated input tensors for every test, created once per module.
+    Tests that differentiate w.r.t. a tensor take a private leaf with .clone().requires_grad_(True).
+    """
+    shapes = {
+        "softmax": {"x": (16, 10, 32), "init_relevance": (16, 10, 32)},
+        "matmul": {"a": (2, 10, 32), "b": (2, 32, 5), "init_relevance": (2, 10, 5)},
+        "linear": {"x": (16, 10), "bias": (5,), "weight": (5, 10), "init_relevance": (16, 5)},
+        "sum": {"a": (16, 10, 32), "b": (16, 10, 32), "init_relevance": (16, 10, 32)},
+        "mean": {"a": (1, 8, 32), "init_relevance": (1, 8)},
+        "layernorm": {"x": (1, 2, 8), "init_relevance": (1, 2, 8), "weight": (8,), "bias": (8,)},
+        "normalize": {"x": (1, 4, 32), "r_gt": (1, 4, 32), "weight": (32,)},
+    }
+    return {
+        test: {name: torch.randn(*shape, generator=rng) for name, shape in inputs.items()}
+        for test, inputs in shapes.items()
+    }
 
-    # test inplace=True
-    y_lxt = lf.softmax(x, -1, torch.float32, True)
-    relevance_lxt, = torch.autograd.grad(y_lxt, x, init_relevance)
-    assert torch.allclose(relevance_gt, relevance_lxt, rtol=0, atol=1e-5)
 
+@pytest.fixture(scope="module")
+def softmax_gt(tensors):
+
+    x = tensors["softmax"]["x"].clone().requires_grad_(True)
+    init_relevance = tensors["softmax"]["init_relevance"]
+
+    with torch.no_grad():
+        y_gt = F.softmax(x, -1)
+
+        # implement Proposition 3.1 of AttnLRP paper
+        # (sums the relevance itself, unlike the softmax Jacobian-vector product (y_gt * init_relevance).sum(-1))
+        relevance_gt = x * (init_relevance - y_gt * init_relevance.sum(-1, keepdim=True))
+
+    return x, init_relevance, relevance_gt
+
+
+@pytest.mark.parametrize("inplace", [False, True])
+def test_softmax(inplace, softmax_gt):
+
+    x, init_relevance, relevance_gt = softmax_gt
+
+    y_lxt = lf.softmax(x, -1, torch.float32, inplace=inplace)
+    relevance_lxt, = torch.autograd.grad(y_lxt, x, init_relevance.clone())  # the inplace backward overwrites grad_outputs
+    assert_close(relevance_gt, relevance_lxt, rtol=0, atol=1e-5)
 
-def test_matmul():
+
+@pytest.fixture(scope="module")
+def matmul_gt(tensors):
 
     epsilon = 1e-9
 
-    a = torch.randn(2, 10, 32, requires_grad=True)
-    b = torch.randn(2, 32, 5, requires_grad=True)
+    a = tensors["matmul"]["a"].clone().requires_grad_(True)
+    b = tensors["matmul"]["b"].clone().requires_grad_(True)
 
-    init_relevance = torch.randn(2, 10, 5, requires_grad=True)
+    init_relevance = tensors["matmul"]["init_relevance"]
 
-    y_gt = torch.matmul(a, b)
+    with torch.no_grad():
+        y_gt = torch.matmul(a, b)
 
-    # implement Proposition 3.3 of AttnLRP paper
-    relevance_a_gt = torch.einsum("bji, bip, bjp -> bji", a, b, init_relevance / (2*y_gt + epsilon))
-    relevance_b_gt = torch.einsum("bji, bip, bjp -> bip", a, b, init_relevance / (2*y_gt + epsilon))
+        # implement Proposition 3.3 of AttnLRP paper
+        ratio = init_relevance / (2*y_gt + epsilon)
+        relevance_a_gt = (b.unsqueeze(1) * ratio.unsqueeze(2)).sum(-1) * a
+        relevance_b_gt = (a.unsqueeze(3) * ratio.unsqueeze(2)).sum(1) * b
+
+    return epsilon, a, b, init_relevance, relevance_a_gt, relevance_b_gt
 
-    # test inplace=False
-    y_lxt = lf.matmul(a, b, False, epsilon)
-    relevance_a_lxt, relevance_b_lxt = torch.autograd.grad(y_lxt, (a, b), init_relevance)
-    assert torch.allclose(relevance_a_gt, relevance_a_lxt, rtol=0, atol=1e-4)
-    assert torch.allclose(relevance_b_gt, relevance_b_lxt, rtol=0, atol=1e-4)
 
-    # test inplace=True
-    y_lxt = lf.matmul(a, b, True, epsilon)
-    relevance_a_lxt, relevance_b_lxt = torch.autograd.grad(y_lxt, (a, b), init_relevance)
-    assert torch.allclose(relevance_a_gt, relevance_a_lxt, rtol=0, atol=1e-4)
-    assert torch.allclose(relevance_b_gt, relevance_b_lxt, rtol=0, atol=1e-4)
+@pytest.mark.parametrize("inplace", [False, True])
+def test_matmul(inplace, matmul_gt):
 
+    epsilon, a, b, init_relevance, relevance_a_gt, relevance_b_gt = matmul_gt
 
-def test_linear():
+    y_lxt = lf.matmul(a, b, inplace, epsilon)
+    relevance_a_lxt, relevance_b_lxt = torch.autograd.grad(y_lxt, (a, b), init_relevance.clone())  # the inplace backward overwrites grad_outputs
+    assert_close(relevance_a_gt, relevance_a_lxt, rtol=0, atol=1e-4)
+    assert_close(relevance_b_gt, relevance_b_lxt, rtol=0, atol=1e-4)
+
+
+def test_linear(tensors):
 
     epsilon = 1e-9
 
-    x = torch.randn(16, 10, requires_grad=True)
-    bias = torch.randn(5, requires_grad=False)
-    weight = torch.randn(5, 10, requires_grad=True)
+    x = tensors["linear"]["x"].clone().requires_grad_(True)
+    bias = tensors["linear"]["bias"]
+    weight = tensors["linear"]["weight"].clone().requires_grad_(True)
 
-    init_relevance = torch.randn(16, 5, requires_grad=True)
+    init_relevance = tensors["linear"]["init_relevance"]
 
-    y_gt = F.linear(x, weight, bias)
+    with torch.no_grad():
+        y_gt = F.linear(x, weight, bias)
 
-    # implement Equation 8 of AttnLRP paper
-    relevace_gt = torch.einsum("ji, bi, bj -> bi", weight, x, init_relevance / (y_gt + epsilon))
+        # implement Equation 8 of AttnLRP paper
+        ratio = init_relevance / (y_gt + epsilon)
+        relevace_gt = x * (ratio @ weight)
 
     # test inplace=False
     y_lxt = lf.linear_epsilon(x, weight, bias, epsilon)
     relevance_lxt, = torch.autograd.grad(y_lxt, x, init_relevance)
 
-    assert torch.allclose(relevace_gt, relevance_lxt, rtol=0, atol=1e-3)
+    assert_close(relevace_gt, relevance_lxt, rtol=0, atol=1e-3)
 
 
-def test_sum():
+@pytest.fixture(scope="module")
+def sum_gt(tensors):
 
     epsilon = 1e-9
 
-    a = torch.randn(16, 10, 32, requires_grad=True)
-    b = torch.randn(16, 10, 32, requires_grad=True)
+    a = tensors["sum"]["a"].clone().requires_grad_(True)
+    b = tensors["sum"]["b"].clone().requires_grad_(True)
 
-    init_relevance = torch.randn(16, 10, 32, requires_grad=True)
+    init_relevance = tensors["sum"]["init_relevance"]
 
-    y_gt = a + b
+    with torch.no_grad():
+        y_gt = a + b
 
-    # implement epsilon rule for summation
-    relevance_a_gt = a * (init_relevance / (y_gt + epsilon))
-    relevance_b_gt = b * (init_relevance / (y_gt + epsilon))
+        # implement epsilon rule for summation
+        ratio = init_relevance / (y_gt + epsilon)
+        relevance_a_gt = a * ratio
+        relevance_b_gt = b * ratio
 
-    # test inplace=False
-    y_lxt = lf.add2(a, b, False, epsilon)
-    relevance_a_lxt, relevance_b_lxt = torch.autograd.grad(y_lxt, (a, b), init_relevance)
+    return epsilon, a, b, init_relevance, relevance_a_gt, relevance_b_gt
 
-    assert torch.allclose(relevance_a_gt, relevance_a_lxt, rtol=0, atol=1e-4)
-    assert torch.allclose(relevance_b_gt, relevance_b_lxt, rtol=0, atol=1e-4)
 
-    # test inplace=True
-    y_lxt = lf.add2(a, b, True, epsilon)
-    relevance_a_lxt, relevance_b_lxt = torch.autograd.grad(y_lxt, (a, b), init_relevance)
+@pytest.mark.parametrize("inplace, atol", [(False, 1e-4), (True, 1e-5)])
+def test_sum(inplace, atol, sum_gt):
 
-    assert torch.allclose(relevance_a_gt, relevance_a_lxt, rtol=0, atol=1e-5)
-    assert torch.allclose(relevance_b_gt, relevance_b_lxt, rtol=0, atol=1e-5)
+    epsilon, a, b, init_relevance, relevance_a_gt, relevance_b_gt = sum_gt
 
+    y_lxt = lf.add2(a, b, inplace, epsilon)
+    relevance_a_lxt, relevance_b_lxt = torch.autograd.grad(y_lxt, (a, b), init_relevance.clone())  # the inplace backward overwrites grad_outputs
 
-def test_mean():
+    assert_close(relevance_a_gt, relevance_a_lxt, rtol=0, atol=atol)
+    assert_close(relevance_b_gt, relevance_b_lxt, rtol=0, atol=atol)
+
+
+@pytest.fixture(scope="module")
+def mean_gt(tensors):
 
     epsilon = 1e-9
 
-    a = torch.randn(1, 8, 32, requires_grad=True)
-    init_relevance = torch.randn(1, 8)
+    a = tensors["mean"]["a"].clone().requires_grad_(True)
+    init_relevance = tensors["mean"]["init_relevance"]
+
+    with torch.no_grad():
+        # implement epsilon rule for mean
+        ratio = init_relevance.unsqueeze(-1) / (a.sum(-1, keepdim=True) + epsilon)
+        relevance_gt = a * ratio
 
-    # implement epsilon rule for mean
-    relevance_gt = a * (init_relevance.unsqueeze(-1) / (a.sum(-1).unsqueeze(-1) + epsilon))
+    return epsilon, a, init_relevance, relevance_gt
 
-    ## --- test keep_dim=True
-    y_lxt = lf.mean(a, -1, True, epsilon)
-    relevance_lxt, = torch.autograd.grad(y_lxt, a, init_relevance.unsqueeze(-1))
 
-    assert torch.allclose(relevance_gt, relevance_lxt, rtol=0, atol=1e-4)
+@pytest.mark.parametrize("keep_dim", [True, False])
+def test_mean(keep_dim, mean_gt):
 
-    ## --- test keep_dim=False
-    y_lxt = lf.mean(a, -1, False, epsilon)
-    relevance_lxt, = torch.autograd.grad(y_lxt, a, init_relevance)
+    epsilon, a, init_relevance, relevance_gt = mean_gt
 
-    assert torch.allclose(relevance_gt, relevance_lxt, rtol=0, atol=1e-4)
+    y_lxt = lf.mean(a, -1, keep_dim, epsilon)
+    relevance_lxt, = torch.autograd.grad(y_lxt, a, init_relevance.unsqueeze(-1) if keep_dim else init_relevance)
 
+    assert_close(relevance_gt, relevance_lxt, rtol=0, atol=1e-4)
 
-def test_layernorm():
 
-    x = torch.randn(1, 2, 8, requires_grad=True)
-    init_relevance = torch.randn(1, 2, 8)
+def test_layernorm(tensors):
+
+    x = tensors["layernorm"]["x"].clone().requires_grad_(True)
+    init_relevance = tensors["layernorm"]["init_relevance"]
 
     layer = torch.nn.LayerNorm(8)
-    weight = torch.randn_like(layer.weight)
-    bias = torch.randn_like(layer.bias)
+    weight = tensors["layernorm"]["weight"]
+    bias = tensors["layernorm"]["bias"]
     layer.weight = nn.Parameter(weight)
     layer.bias = nn.Parameter(bias)
     layer.weight.requires_grad_(False)
@@ -150,42 +209,35 @@ def test_layernorm():
     y = lf._layer_norm_slower(x, weight, bias, layer.eps)
     relevance_lxt, = torch.autograd.grad(y, x, init_relevance)
 
-    assert torch.allclose(relevance_lxt, relevance_gt, rtol=0, atol=1e-1)
+    assert_close(relevance_lxt, relevance_gt, rtol=0, atol=1e-1)
 
     # compute cosine similarity
-    rel_gt = relevance_gt.flatten()
-    rel_lxt = relevance_lxt.flatten()
-
-    cos_sim = torch.dot(rel_gt, rel_lxt) / (torch.norm(rel_gt) * torch.norm(rel_lxt))
+    cos_sim = F.cosine_similarity(relevance_gt.view(1, -1), relevance_lxt.view(1, -1), dim=-1).item()
     assert cos_sim > 0.99
 
 
-def test_normalize():
+def test_normalize(tensors):
 
-    x = torch.randn(1, 4, 32, requires_grad=True)
-    r_gt = torch.randn(1, 4, 32)
+    x = tensors["normalize"]["x"].clone().requires_grad_(True)
+    r_gt = tensors["normalize"]["r_gt"]
 
-    weight, variance_epsilon = torch.randn(32), 1e-9
+    weight, variance_epsilon = tensors["normalize"]["weight"], 1e-9
     y = lf.rms_norm_identity(x, weight, variance_epsilon)
     y.backward(r_gt)
 
-    assert torch.allclose(x.grad, r_gt, rtol=0, atol=1e-5)
+    assert_close(x.grad, r_gt, rtol=0, atol=1e-5)
     x.grad.zero_()
 
     y = lf.normalize(x, p=2, dim=1)
     y.backward(r_gt)
 
-    assert torch.allclose(x.grad, r_gt, rtol=0, atol=1e-5)
+    assert_close(x.grad, r_gt, rtol=0, atol=1e-5)
 
 
 if __name__ == "__main__":
 
-    test_softmax()
-    test_matmul()
-    test_linear()
-    test_sum()
-    test_mean()
-    test_layernorm()
-    test_normalize()
+    import sys
 
-    print("ALL TESTS PASSED")
\ No newline at end of file
+    # the tests depend on fixtures, so they have to be collected by pytest
+    # (with pytest-xdist installed, pass -n auto on the command line to run them in parallel)
+    sys.exit(pytest.main([__file__, "-x", "-q"]))
\ No newline at end of file